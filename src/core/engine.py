@@ -1,12 +1,19 @@
 #  Copyright (c) 2024. Gaspard Merten
 #  All rights reserved.
 
+import contextlib
+import heapq
+import itertools
+import math
+import mmap
 import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from typing import List, Tuple
 
-from filelock import FileLock
-
 from src.core.constants import BUFFER
 from src.core.io_manager.base import IOManager
 from src.core.mixins.loggable import LoggableComponent
@@ -14,8 +21,18 @@ from src.core.models import DataType
 from src.core.persistence import PersistenceManager
 from src.core.storage.base import InternalStorageManager
 from src.core.utils.exception import AnotherWorldException
+from src.core.utils.file_lock import try_lock_file
+
+# Lock file taken by the process checking the storage integrity on startup
+STARTUP_LOCK = "startup.lock"
 
 DEFAULT_BUFFER_SIZE = 100 * 1024 * 1024  # 100MB
+DEFAULT_BUFFER_MAX_ROWS = 100_000
+DEFAULT_BUFFER_MAX_TIME = 60 * 60  # 1 hour
+# Buffers growing past this many times BUFFER_MAX_BYTES are flushed by store itself
+BUFFER_HARD_LIMIT_FACTOR = 2
+# Number of seconds between two checks of the age of the buffers by the flusher
+FLUSHER_INTERVAL = 10
 
 
 class Engine(LoggableComponent):
@@ -29,32 +46,61 @@ class Engine(LoggableComponent):
         self.internal_storage = internal_storage
         self.io_manager = io_manager
         self.persistence_manager = persistence_manager
-        self.startup_lock = FileLock("startup.lock")
+        # Serializes the operations touching the buffer of a collection (store, flush, buffer reads)
+        self._collection_locks = {}
+        # Time (monotonic) at which the current buffer of each collection received its first item
+        self._buffer_started_at = {}
+        self.reload_config()
+        # Reads the fragments of a query concurrently, IO_PARALLELISM bounds the number of
+        # fragments read at once (default: number of CPUs)
+        self._read_executor = ThreadPoolExecutor(
+            max_workers=int(os.environ.get("IO_PARALLELISM", os.cpu_count() or 4))
+        )
+        # Buffers exceeding their thresholds are flushed by a background thread, so that store
+        # does not have to wait for the flush
+        self._flush_queue = queue.Queue()
+        self._queued_flushes = set()
+        threading.Thread(target=self._run_flusher, name="flusher", daemon=True).start()
+
+    def _get_collection_lock(self, collection_name: str) -> threading.RLock:
+        """
+        Get the lock guarding the buffer of the collection with the given name.
+        :param collection_name: The name of the collection
+        :return: The lock of the collection
+        """
+        return self._collection_locks.setdefault(collection_name, threading.RLock())
 
     def check_for_storage_integrity(self):
         """
         On startup, the Lake should check the storage integrity and fix any inconsistency.
         """
-        try:
-            with self.startup_lock.acquire(blocking=False):
-                self.log("Checking for storage integrity, acquiring lock")
-                for (
-                    collection
-                ) in self.persistence_manager.get_collections_with_active_buffer():
-                    self.log_warning(
-                        f"Collection {collection.name} has an active buffer, flushing it"
-                    )
-                    try:
-                        self.flush(collection.name)
-                    except Exception as e:
-                        self.log_error(
-                            f"Failed to flush buffer for collection {collection.name}, {e}"
-                        )
-
-        except TimeoutError:
+        lock_fd = try_lock_file(STARTUP_LOCK)
+
+        if lock_fd is None:
             self.log_warning(
                 "Startup lock already acquired, skipping storage integrity check"
             )
+            return
+
+        try:
+            self.log("Checking for storage integrity, acquiring lock")
+            for (
+                collection
+            ) in self.persistence_manager.get_collections_with_active_buffer():
+                self.log_warning(
+                    "Collection %s has an active buffer, flushing it", collection.name
+                )
+                try:
+                    self.flush(collection.name)
+                except Exception as e:
+                    self.log_error(
+                        "Failed to flush buffer for collection %s, %s",
+                        collection.name,
+                        e,
+                    )
+        finally:
+            # Closing the file releases the lock
+            os.close(lock_fd)
 
     def create_collection(self, collection_name: str, allow_existing: bool = False):
         """
@@ -66,7 +112,7 @@ class Engine(LoggableComponent):
 
         self.io_manager.create_collection(collection_name)
         self.persistence_manager.create_collection(collection_name, allow_existing)
-        self.log(f"Collection {collection_name} created")
+        self.log("Collection %s created", collection_name)
 
     def list_collections(self) -> List[dict]:
         """
@@ -103,30 +149,118 @@ class Engine(LoggableComponent):
             try:
                 self.persistence_manager.get_collection_by_name(collection_name)
             except AnotherWorldException:
+                # Concurrent first stores may all try to create the collection, only one of them
+                # actually creates it and the others must still store their data
+                self.create_collection(collection_name, allow_existing=True)
+
+        with self._get_collection_lock(collection_name):
+            # Append the segment to the buffered fragment
+            current_size = self.io_manager.get_size(collection_name, BUFFER)
+
+            # Append the data to the buffered fragment
+            with self.io_manager.get_append_context(collection_name, BUFFER) as f:
+                f.write(data)
+
+            segments_count = (
+                self.persistence_manager.append_segments_to_buffer_fragment(
+                    collection_name,
+                    (
+                        current_size,
+                        current_size + len(data),
+                        int(timestamp.timestamp()),
+                        data_type.value if data_type is not None else None,
+                    ),
+                )
+            )
 
-                self.create_collection(collection_name)
+            # The new size of the buffer is known, there is no need to ask the IO manager again
+            buffer_size = current_size + len(data)
+            if buffer_size > BUFFER_HARD_LIMIT_FACTOR * self._buffer_max_bytes:
+                # The flusher is falling behind, the buffer is flushed before accepting more data
+                self.flush(collection_name)
+            elif self._should_flush(collection_name, buffer_size, segments_count):
+                self._schedule_flush(collection_name)
 
-        # Append the segment to the buffered fragment
-        current_size = self.io_manager.get_size(collection_name, BUFFER)
+    def reload_config(self) -> None:
+        """
+        Read the thresholds above which a buffer is flushed from the environment:
+            - BUFFER_MAX_BYTES (or BUFFER_SIZE): The size of the buffer in bytes (default: 100MB)
+            - BUFFER_MAX_ROWS: The number of items in the buffer (default: 100 000)
+            - BUFFER_MAX_TIME: The number of seconds since the first item of the buffer (default: 1 hour)
+        They are read once on initialization, this method only needs to be called again if the
+        environment changes at runtime.
+        :return: None
+        """
+        self._buffer_max_bytes = int(
+            os.environ.get(
+                "BUFFER_MAX_BYTES", os.environ.get("BUFFER_SIZE", DEFAULT_BUFFER_SIZE)
+            )
+        )
+        self._buffer_max_rows = int(
+            os.environ.get("BUFFER_MAX_ROWS", DEFAULT_BUFFER_MAX_ROWS)
+        )
+        self._buffer_max_time = float(
+            os.environ.get("BUFFER_MAX_TIME", DEFAULT_BUFFER_MAX_TIME)
+        )
 
-        # Append the data to the buffered fragment
-        with self.io_manager.get_append_context(collection_name, BUFFER) as f:
-            f.write(data)
+    def _should_flush(
+        self, collection_name: str, buffer_size: int, segments_count: int
+    ) -> bool:
+        """
+        Check whether the buffer of the collection must be flushed. This is the case as soon as one
+        of the thresholds (see reload_config) is exceeded.
+        :param collection_name: The name of the collection
+        :param buffer_size: The size of the buffer in bytes
+        :param segments_count: The number of items in the buffer
+        :return: True if the buffer must be flushed, False otherwise
+        """
+        buffer_started_at = self._buffer_started_at.setdefault(
+            collection_name, time.monotonic()
+        )
 
-        self.persistence_manager.append_segments_to_buffer_fragment(
-            collection_name,
-            (
-                current_size,
-                current_size + len(data),
-                int(timestamp.timestamp()),
-                data_type.value if data_type is not None else None,
-            ),
+        return (
+            buffer_size > self._buffer_max_bytes
+            or segments_count > self._buffer_max_rows
+            or time.monotonic() - buffer_started_at > self._buffer_max_time
         )
 
-        if self.io_manager.get_size(collection_name, BUFFER) > os.environ.get(
-            "BUFFER_SIZE", DEFAULT_BUFFER_SIZE
-        ):  # 500MB
-            self.flush(collection_name)
+    def _schedule_flush(self, collection_name: str) -> None:
+        """
+        Ask the flusher to flush the buffer of the collection, unless it is already scheduled.
+        :param collection_name: The name of the collection to flush
+        :return: None
+        """
+        if collection_name not in self._queued_flushes:
+            self._queued_flushes.add(collection_name)
+            self._flush_queue.put_nowait(collection_name)
+
+    def _run_flusher(self) -> None:
+        """
+        Flush the buffers scheduled by store. When idle, the flusher also schedules the buffers
+        exceeding BUFFER_MAX_TIME, so that collections that stopped receiving data are flushed too.
+        :return: None
+        """
+        while True:
+            try:
+                collection_name = self._flush_queue.get(timeout=FLUSHER_INTERVAL)
+            except queue.Empty:
+                now = time.monotonic()
+
+                for collection_name, started_at in list(
+                    self._buffer_started_at.items()
+                ):
+                    if now - started_at > self._buffer_max_time:
+                        self._schedule_flush(collection_name)
+                continue
+
+            self._queued_flushes.discard(collection_name)
+
+            try:
+                self.flush(collection_name)
+            except Exception as e:
+                self.log_error(
+                    "Failed to flush buffer for collection %s, %s", collection_name, e
+                )
 
     def flush(self, collection_name: str) -> bool:
         """
@@ -140,46 +274,80 @@ class Engine(LoggableComponent):
         :return: True if the data was flushed, False otherwise
         """
 
-        if not self.persistence_manager.has_buffered_fragment(collection_name):
-            return False
+        with self._get_collection_lock(collection_name):
+            # The collection is looked up once for the whole flush
+            collection = self.persistence_manager.get_collection_by_name(
+                collection_name
+            )
 
-        # Create a new fragment from the buffered fragment
-        segments, associated_fragment_uuid = (
-            self.persistence_manager.associate_new_fragment_to_buffer(collection_name)
-        )
-        data_types = [segment[3] for segment in segments]
-
-        if len(set(data_types)) > 1:
-            data_type = DataType.RAW
-        else:
-            data_type = DataType(data_types[0]) if data_types[0] is not None else None
-
-        # Write the data in the buffered fragment to the new fragment
-        with self.io_manager.get_read_context(collection_name, BUFFER) as f:
-            with self.io_manager.get_write_context(
-                collection_name, associated_fragment_uuid
-            ) as output:
-                # Read and Split the data
-                data = f.read()
-                items = [
-                    (data[segment[0] : segment[1]], segment[2]) for segment in segments
-                ]
-                # Write the data
-                metadata = self.internal_storage.write(items, output, data_type)
-
-        # Remove the buffered fragment and create items
-        self.persistence_manager.remove_buffered_fragment_and_create_items(
-            collection_name, metadata
-        )
+            if not self.persistence_manager.has_buffered_fragment(collection):
+                return False
 
-        # Remove the buffer file
-        os.remove(os.path.join(self.io_manager.storage_folder, collection_name, BUFFER))
+            # Create a new fragment from the buffered fragment
+            segments, associated_fragment_uuid = (
+                self.persistence_manager.associate_new_fragment_to_buffer(collection)
+            )
 
-        self.log(
-            f"Buffered data flushed to new fragment in collection {collection_name}"
-        )
+            # A buffered fragment without segments has nothing to write
+            if not segments:
+                return False
+
+            data_types = [segment[3] for segment in segments]
+
+            if len(set(data_types)) > 1:
+                data_type = DataType.RAW
+            else:
+                data_type = (
+                    DataType(data_types[0]) if data_types[0] is not None else None
+                )
+
+            # Write the data in the buffered fragment to the new fragment
+            with self.io_manager.get_read_context(collection_name, BUFFER) as f:
+                with self.io_manager.get_write_context(
+                    collection_name, associated_fragment_uuid
+                ) as output:
+                    # Split the data, the buffer is mapped rather than read as a whole
+                    with self._map_buffer(f) as data:
+                        items = [
+                            (data[segment[0] : segment[1]], segment[2])
+                            for segment in segments
+                        ]
+                    # Write the data
+                    metadata = self.internal_storage.write(items, output, data_type)
+
+            # Remove the buffered fragment and create items
+            self.persistence_manager.remove_buffered_fragment_and_create_items(
+                collection, metadata
+            )
+
+            self._buffer_started_at.pop(collection_name, None)
+
+            # Remove the buffer file
+            self.io_manager.remove_fragment(collection_name, BUFFER)
+
+            self.log(
+                "Buffered data flushed to new fragment in collection %s",
+                collection_name,
+            )
+
+            return True
+
+    @staticmethod
+    @contextlib.contextmanager
+    def _map_buffer(f):
+        """
+        Map the buffer in memory, so that its segments can be sliced without first copying the
+        whole buffer into memory.
+        :param f: The buffer to map
+        :return: A context manager yielding the mapped buffer
+        """
+        if os.fstat(f.fileno()).st_size == 0:
+            # Empty files cannot be mapped
+            yield b""
+            return
 
-        return True
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            yield data
 
     def query(
         self,
@@ -201,58 +369,114 @@ class Engine(LoggableComponent):
         :return: The data in the collection as a list of tuples of bytes and datetime
         """
         collection = self.persistence_manager.get_collection_by_name(collection_name)
-        fragments = self.persistence_manager.query(
-            collection, min_timestamp, max_timestamp, ascending, limit
-        )
 
-        result = []
+        # The offset is applied after merging, so each source must provide limit + offset items
+        offset = offset or 0
+        needed = limit + offset if limit else None
 
-        for fragment in fragments:
-            result.extend(
-                self._get_fragment_items(
-                    collection, fragment, min_timestamp, max_timestamp, ascending, limit
-                )
+        # The fragments and the buffer are taken together under the collection lock, so that a flush
+        # moving the buffered items to a new fragment cannot happen in between. The fragment files
+        # are only read once the lock is released.
+        with self._get_collection_lock(collection_name):
+            fragments = self.persistence_manager.query(
+                collection, min_timestamp, max_timestamp, ascending, needed
+            )
+            buffer_data, buffer_segments = self._copy_buffer(
+                collection, min_timestamp, max_timestamp
             )
 
-        result.extend(
-            self._get_data_from_buffer(collection, min_timestamp, max_timestamp)
+        # Each fragment is read in the requested order, the buffer is sorted to match them.
+        # Fragments are read concurrently, as their decoding mostly happens outside the GIL.
+        sources = list(
+            self._read_executor.map(
+                lambda fragment: self._get_fragment_items(
+                    collection,
+                    fragment,
+                    min_timestamp,
+                    max_timestamp,
+                    ascending,
+                    needed,
+                ),
+                fragments,
+            )
+        )
+        sources.append(
+            sorted(
+                self._split_buffer(buffer_data, buffer_segments),
+                key=lambda x: x[1],
+                reverse=not ascending,
+            )
         )
 
-        # Sort the result by timestamp
-        result.sort(key=lambda x: x[1], reverse=not ascending)
+        # Merge the sorted sources instead of sorting their concatenation
+        result = list(
+            itertools.islice(
+                heapq.merge(*sources, key=lambda x: x[1], reverse=not ascending),
+                offset,
+                needed,
+            )
+        )
 
         self.log(
-            f"Querying data in collection {collection_name}, found {len(result)} items, ascending={ascending}, limit="
-            f"{limit}, min_timestamp={min_timestamp}, max_timestamp={max_timestamp}"
+            "Querying data in collection %s, found %d items, ascending=%s, limit=%s, "
+            "min_timestamp=%s, max_timestamp=%s",
+            collection_name,
+            len(result),
+            ascending,
+            limit,
+            min_timestamp,
+            max_timestamp,
         )
 
-        if offset:
-            result = result[offset:]
-
-        if limit:
-            result = result[:limit]
-
         return result
 
-    def _get_data_from_buffer(self, collection, min_timestamp, max_timestamp):
+    def _copy_buffer(
+        self, collection, min_timestamp, max_timestamp
+    ) -> Tuple[bytes, List[Tuple]]:
+        """
+        Copy the segments of the buffer in the time range, along with the bytes they span, so that
+        they can be used once the collection lock is released. The lock must be held by the caller.
+        :param collection: The collection whose buffer is copied
+        :param min_timestamp: The minimum timestamp of the segments
+        :param max_timestamp: The maximum timestamp of the segments
+        :return: The copied bytes, and the segments with offsets relative to these bytes
+        """
         buffer = self.persistence_manager.get_buffered_fragment(collection)
 
         if buffer is None:
-            return []
+            return b"", []
+
+        # Only the segments in the time range are copied from the buffer. Their timestamps are
+        # integer seconds, so the bounds are converted once instead of each segment.
+        min_seconds = math.ceil(min_timestamp.timestamp())
+        max_seconds = math.floor(max_timestamp.timestamp())
+        segments = self.persistence_manager.get_buffered_segments(
+            buffer, min_seconds, max_seconds
+        )
+
+        if not segments:
+            return b"", []
 
-        segments = buffer.segments
+        start = min(segment[0] for segment in segments)
+        end = max(segment[1] for segment in segments)
 
         with self.io_manager.get_read_context(collection.name, BUFFER) as f:
-            # Split the data
-            data = f.read()
+            f.seek(start)
+            data = f.read(end - start)
 
-            items = [
-                (data[segment[0] : segment[1]], segment[2])
-                for segment in segments
-                if min_timestamp <= datetime.fromtimestamp(segment[2]) <= max_timestamp
-            ]
+        return data, [
+            (segment[0] - start, segment[1] - start, segment[2]) for segment in segments
+        ]
 
-        return items
+    @staticmethod
+    def _split_buffer(data: bytes, segments: List[Tuple]) -> List[Tuple[bytes, int]]:
+        """
+        Split the bytes copied from the buffer into the data of each segment.
+        :param data: The bytes copied from the buffer
+        :param segments: The segments, with offsets relative to the copied bytes
+        :return: The data and timestamp of each segment
+        """
+        return [(data[segment[0] : segment[1]], segment[2]) for segment in segments]
 
     def _get_fragment_items(
         self, collection, fragment, min_timestamp, max_timestamp, ascending, limit
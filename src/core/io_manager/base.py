@@ -5,6 +5,7 @@ from typing import Protocol
 
 # noinspection PyArgumentList
 class IOManager(Protocol):
+    __slots__ = ()
 
     def get_fragment_context(self, collection_name: str, identifier: str, mode: str):
         """
@@ -65,3 +66,12 @@ class IOManager(Protocol):
         :return: A context manager that yields a fragment-like object
         """
         ...
+
+    def remove_fragment(self, collection_name: str, fragment_uuid: str):
+        """
+        This method should remove the fragment corresponding to the given fragment UUID.
+        :param collection_name: The name of the collection
+        :param fragment_uuid: The UUID of the fragment
+        :return: None
+        """
+        ...
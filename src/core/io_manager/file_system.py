@@ -2,27 +2,54 @@
 #  All rights reserved.
 
 import contextlib
+import functools
 import os
-import re
-from collections import defaultdict
-from multiprocessing import Lock
+import string
+import threading
 
 from src.core.io_manager.base import IOManager
 
+# Fragment identifiers are made of these characters only, so they cannot escape their collection folder
+IDENTIFIER_CHARACTERS = frozenset(string.ascii_letters + string.digits + "_-")
+
+# Number of locks shared by the fragments, a fragment always maps to the same lock
+FRAGMENT_LOCK_STRIPES = 1024
+
+
+@functools.lru_cache(maxsize=4096)
+def _join_path(storage_folder: str, collection_name: str, identifier: str) -> str:
+    """
+    Join the path of a fragment, cached as the same fragments are accessed over and over.
+    """
+    return os.path.join(storage_folder, collection_name, identifier)
+
 
-# noinspection PyArgumentList
 class FileSystemIOManager(IOManager):
+    __slots__ = ("created_collections", "fragment_locks", "storage_folder")
+
     def __init__(self, storage_folder: str) -> None:
         """
         This class implements the IOManager interface using the fragment system.
         :param storage_folder: The folder where the data will be stored
         """
-        self.fragment_locks = defaultdict(Lock)
-        self.wait_queue = defaultdict(list)
+        # Fixed set of locks, so that no shared structure needs to be guarded to find the lock
+        # of a fragment. A lock is never held while acquiring another one, so two fragments
+        # sharing a lock can only wait for each other, not deadlock. These are thread locks: they
+        # only coordinate the threads of one process, the server is meant to run a single worker.
+        self.fragment_locks = [threading.Lock() for _ in range(FRAGMENT_LOCK_STRIPES)]
         self.storage_folder = storage_folder
+        # Collections whose folder is known to exist, so that it is not created again
+        self.created_collections = set()
         # Ensure the storage folder exists
         os.makedirs(storage_folder, exist_ok=True)
-        self.global_lock = Lock()
+
+    def _get_lock(self, fragment_identifier: str) -> threading.Lock:
+        """
+        Get the lock for the given fragment identifier.
+        :param fragment_identifier: The identifier of the fragment to get the lock for
+        :return: The lock of the fragment
+        """
+        return self.fragment_locks[hash(fragment_identifier) % FRAGMENT_LOCK_STRIPES]
 
     def _acquire_lock(self, fragment_identifier: str) -> None:
         """
@@ -30,9 +57,7 @@ class FileSystemIOManager(IOManager):
         :param fragment_identifier: The identifier of the fragment to acquire the lock for
         :return: None
         """
-        with self.global_lock:
-            fragment_lock = self.fragment_locks[fragment_identifier]
-            fragment_lock.acquire()
+        self._get_lock(fragment_identifier).acquire()
 
     def _release_lock(self, fragment_identifier: str) -> None:
         """
@@ -40,45 +65,52 @@ class FileSystemIOManager(IOManager):
         :param fragment_identifier: The identifier of the fragment to release the lock for
         :return: None
         """
+        self._get_lock(fragment_identifier).release()
 
-        with self.global_lock:
-            fragment_lock = self.fragment_locks[fragment_identifier]
-            fragment_lock.release()
-            # Check and notify the first operation in the wait queue, if any
-            if self.wait_queue[fragment_identifier]:
-                next_operation = self.wait_queue[fragment_identifier].pop(0)
-                next_operation.set()
+    def _get_path(self, collection_name: str, identifier: str) -> str:
+        """
+        Get the path of the fragment with the given identifier.
+        :param collection_name: The name of the collection
+        :param identifier: The identifier of the fragment
+        :return: The path of the fragment
+        """
+        return _join_path(self.storage_folder, collection_name, identifier)
 
     @contextlib.contextmanager
     def get_fragment_context(self, collection_name: str, identifier: str, mode: str):
-        fragment_identifier = os.path.join(collection_name, identifier)
+        # Identifiers are validated before taking any lock
+        if not identifier or not IDENTIFIER_CHARACTERS.issuperset(identifier):
+            raise ValueError(
+                f"Invalid identifier: {identifier}, must match [a-zA-Z0-9_-]+"
+            )
+
+        # The path of the fragment also identifies its lock
+        path = self._get_path(collection_name, identifier)
+        locked = "w" in mode or "a" in mode
+
+        if locked:
+            self._acquire_lock(path)
+
         try:
-            if "w" in mode or "a" in mode:
-                self._acquire_lock(fragment_identifier)
-            if not re.search(r"[a-zA-Z0-9_-]", identifier):
-                raise ValueError(
-                    f"Invalid identifier: {identifier}, must match [^a-zA-Z0-9_-]"
-                )
-
-            with open(
-                os.path.join(self.storage_folder, collection_name, identifier), mode
-            ) as f:
+            with open(path, mode) as f:
                 yield f
         finally:
-            if "w" in mode or "a" in mode:
-                self._release_lock(fragment_identifier)
+            if locked:
+                self._release_lock(path)
 
     def get_size(self, collection_name: str, fragment_uuid: str) -> int:
-        if os.path.exists(
-            os.path.join(self.storage_folder, collection_name, fragment_uuid)
-        ):
-            return os.path.getsize(
-                os.path.join(self.storage_folder, collection_name, fragment_uuid)
-            )
-        return 0
+        # A single stat, rather than one to check the existence of the file and one for its size
+        try:
+            return os.stat(self._get_path(collection_name, fragment_uuid)).st_size
+        except FileNotFoundError:
+            return 0
 
     def create_collection(self, collection_name: str):
+        if collection_name in self.created_collections:
+            return
+
         os.makedirs(os.path.join(self.storage_folder, collection_name), exist_ok=True)
+        self.created_collections.add(collection_name)
 
     @contextlib.contextmanager
     def get_read_context(self, collection_name: str, fragment_uuid: str):
@@ -96,3 +128,6 @@ class FileSystemIOManager(IOManager):
             collection_name, fragment_uuid, "ab+"
         ) as context:
             yield context
+
+    def remove_fragment(self, collection_name: str, fragment_uuid: str):
+        os.remove(self._get_path(collection_name, fragment_uuid))
@@ -18,26 +18,29 @@ class LoggableComponent:
             self.__class__.__name__ + " - " + self.internal_uuid
         )
 
-    def log(self, message: str) -> None:
+    def log(self, message: str, *args) -> None:
         """
-        Log a message with the logger
-        :param message: The message to log
+        Log a message with the logger. The message is only formatted with the args if it is emitted.
+        :param message: The message to log, as a %-format string
+        :param args: The arguments of the message
         :return: None
         """
-        self._logger.info(message)
+        self._logger.info(message, *args)
 
-    def log_error(self, message: str) -> None:
+    def log_error(self, message: str, *args) -> None:
         """
         Log an error message with the logger
-        :param message:  The error message to log
+        :param message:  The error message to log, as a %-format string
+        :param args: The arguments of the message
         :return: None
         """
-        self._logger.error(message)
+        self._logger.error(message, *args)
 
-    def log_warning(self, message: str) -> None:
+    def log_warning(self, message: str, *args) -> None:
         """
         Log a warning message with the logger
-        :param message: The warning message to log
+        :param message: The warning message to log, as a %-format string
+        :param args: The arguments of the message
         :return: None
         """
-        self._logger.warning(message)
+        self._logger.warning(message, *args)
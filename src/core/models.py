@@ -1,4 +1,5 @@
 from enum import Enum
+from typing import NamedTuple
 
 
 class DataType(Enum):
@@ -7,3 +8,12 @@ class DataType(Enum):
     GTFS_RT = 2
     CSV = 3
     GTFS = 4
+
+
+class CollectionReference(NamedTuple):
+    """
+    The id and name of a collection, detached from any database session so that it can be cached.
+    """
+
+    id: int
+    name: str
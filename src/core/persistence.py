@@ -1,25 +1,73 @@
 #  Copyright (c) 2024. Gaspard Merten
 #  All rights reserved.
 
+import threading
+import time
 import uuid
 from datetime import datetime
 from functools import wraps
 from typing import Tuple, List
 
-from sqlalchemy import create_engine, func
-from sqlalchemy.exc import IntegrityError, NoResultFound
+from sqlalchemy import (
+    JSON,
+    case,
+    column,
+    create_engine,
+    delete,
+    func,
+    insert,
+    inspect,
+    make_url,
+    or_,
+    select,
+    table,
+    text,
+    update,
+)
+from sqlalchemy.exc import IntegrityError, NoResultFound, SQLAlchemyError
 from sqlalchemy.orm import Session, sessionmaker
 
-from src.core.tables import Base, Collection, BufferedFragment, Fragment, Item
+from src.core.tables import (
+    Base,
+    Collection,
+    BufferedFragment,
+    BufferedSegment,
+    CollectionStats,
+    Fragment,
+    Item,
+)
+from src.core.models import CollectionReference
 from src.core.utils.exception import AnotherWorldException
 
+DEFAULT_POOL_SIZE = 16
+DEFAULT_MAX_OVERFLOW = 16
+
+# Number of seconds a collection looked up by name is reused before being fetched again
+COLLECTION_CACHE_TTL = 30
+
+# Number of seconds the aggregated statistics of the flushed items are reused when listing collections
+COLLECTIONS_STAT_CACHE_TTL = 2
+
 
 def with_session(func_to_wrap):
     @wraps(func_to_wrap)
     def wrapper(self, *args, **kwargs):
-        with self.session_maker.begin() as session:
+        # Nested calls reuse the session (and thus the connection) of the calling method
+        session = getattr(self._local, "session", None)
+        if session is not None:
             return func_to_wrap(self, session, *args, **kwargs)
 
+        with self.session_maker.begin() as session:
+            self._local.session = session
+            try:
+                return func_to_wrap(self, session, *args, **kwargs)
+            except SQLAlchemyError:
+                # The transaction is rolled back, the collections it looked up may be out of date
+                self._collection_cache.clear()
+                raise
+            finally:
+                self._local.session = None
+
     return wrapper
 
 
@@ -30,13 +78,41 @@ class PersistenceManager:
     data.
     """
 
-    def __init__(self, db_url: str) -> None:
+    def __init__(
+        self,
+        db_url: str,
+        pool_size: int = DEFAULT_POOL_SIZE,
+        max_overflow: int = DEFAULT_MAX_OVERFLOW,
+    ) -> None:
+        """
+        Initialize the PersistenceManager with the given database.
+        :param db_url: The URL of the database
+        :param pool_size: The number of connections kept open in the pool
+        :param max_overflow: The number of connections that can be opened beyond the pool size
+        """
+        # The pool is sized for the query and flush threads using the database concurrently,
+        # except for in-memory SQLite databases which use a connection per thread
+        url = make_url(db_url)
+        pool_options = {"pool_size": pool_size, "max_overflow": max_overflow}
+        if url.get_backend_name() == "sqlite" and url.database in (
+            None,
+            "",
+            ":memory:",
+        ):
+            pool_options = {}
+
         # Create sqlite engine (make it read and write (force it to be read and write))
-        self.engine = create_engine(db_url)
+        self.engine = create_engine(db_url, **pool_options)
         self._create_tables()
         self.session_maker = sessionmaker(
             self.engine, expire_on_commit=False, autoflush=True
         )
+        # Holds the session of the method currently running in each thread
+        self._local = threading.local()
+        # Collections looked up by name, with the time until which they can be reused
+        self._collection_cache = {}
+        # Aggregated statistics of the flushed items, with the time until which they can be reused
+        self._collections_stat_cache = None
 
     def _create_tables(self) -> None:
         """
@@ -44,6 +120,115 @@ class PersistenceManager:
         """
 
         Base.metadata.create_all(self.engine)
+        self._migrate_buffered_segments()
+
+        self._backfill_collection_stats()
+
+    def _backfill_collection_stats(self) -> None:
+        """
+        Compute the statistics of the collections created before the statistics table existed, so
+        that every collection has a statistics row that flushes only need to update.
+        """
+
+        try:
+            with self.engine.begin() as connection:
+                connection.execute(
+                    insert(CollectionStats).from_select(
+                        ["collection_id", "min_timestamp", "max_timestamp", "count"],
+                        select(
+                            Collection.id,
+                            func.min(Item.timestamp),
+                            func.max(Item.timestamp),
+                            func.count(Item.timestamp),
+                        )
+                        .outerjoin(Item)
+                        .where(
+                            Collection.id.not_in(select(CollectionStats.collection_id))
+                        )
+                        .group_by(Collection.id),
+                    )
+                )
+        except IntegrityError:
+            # Another process started at the same time and inserted the same statistics
+            pass
+
+    def _migrate_buffered_segments(self) -> None:
+        """
+        Move the segments of databases created before the buffered_segment table out of the JSON
+        segments column of buffered_fragment, count them in segment_count, and drop the old column.
+        """
+
+        columns = self._get_buffered_fragment_columns()
+
+        if "segments" not in columns and "segment_count" in columns:
+            return
+
+        # The legacy column is not part of the model anymore
+        legacy_buffered_fragment = table(
+            "buffered_fragment", column("id"), column("segments", JSON)
+        )
+
+        try:
+            with self.engine.begin() as connection:
+                if "segment_count" not in columns:
+                    connection.execute(
+                        text(
+                            "ALTER TABLE buffered_fragment "
+                            "ADD COLUMN segment_count INTEGER NOT NULL DEFAULT 0"
+                        )
+                    )
+
+                if "segments" in columns:
+                    rows = connection.execute(
+                        select(
+                            legacy_buffered_fragment.c.id,
+                            legacy_buffered_fragment.c.segments,
+                        )
+                    ).all()
+
+                    for buffered_fragment_id, segments in rows:
+                        segments = segments or []
+
+                        if segments:
+                            connection.execute(
+                                insert(BufferedSegment),
+                                [
+                                    {
+                                        "buffered_fragment_id": buffered_fragment_id,
+                                        "start": start,
+                                        "end": end,
+                                        "timestamp": timestamp,
+                                        "data_type": data_type,
+                                    }
+                                    for start, end, timestamp, data_type in segments
+                                ],
+                            )
+
+                        connection.execute(
+                            update(BufferedFragment)
+                            .where(BufferedFragment.id == buffered_fragment_id)
+                            .values(segment_count=len(segments))
+                        )
+
+                    connection.execute(
+                        text("ALTER TABLE buffered_fragment DROP COLUMN segments")
+                    )
+        except SQLAlchemyError:
+            # Another process may have migrated the table at the same time
+            columns = self._get_buffered_fragment_columns()
+            if "segments" in columns or "segment_count" not in columns:
+                raise
+
+    def _get_buffered_fragment_columns(self) -> set:
+        """
+        Get the names of the columns of the buffered_fragment table, as found in the database.
+        :return: The names of the columns
+        """
+
+        return {
+            column["name"]
+            for column in inspect(self.engine).get_columns("buffered_fragment")
+        }
 
     @with_session
     def create_collection(
@@ -60,7 +245,11 @@ class PersistenceManager:
         try:
             collection = Collection(name=collection_name)
             session.add(collection)
+            session.flush()
+            # The statistics row is created along with the collection, flushes only update it
+            session.add(CollectionStats(collection_id=collection.id, count=0))
             session.commit()
+            self._collections_stat_cache = None
         except IntegrityError:
             # If the collection already exists, rollback the transaction
 
@@ -77,20 +266,8 @@ class PersistenceManager:
         :return: A list of collections
         """
 
-        # Create an aggregate query to get all collections + add min/max timestamp and count
-        # noinspection PyTypeChecker
-        results = (
-            session.query(
-                Collection,
-                func.min(Item.timestamp).label("min_timestamp"),
-                func.max(Item.timestamp).label("max_timestamp"),
-                func.count(Item.timestamp).label("count"),
-            )
-            .outerjoin(Item)
-            .group_by(Collection.id)
-            .all()
-        )
-
+        # The aggregate over the items only changes on flush, while the buffers change on every store
+        results = self._get_collections_item_stat()
         buffer_stat = self.get_collections_buffer_stat()
 
         # Create a list of dictionaries with the collection name, min/max timestamp, and count
@@ -121,18 +298,63 @@ class PersistenceManager:
 
         return collections
 
+    def _get_collections_item_stat(self) -> list:
+        """
+        Get all collections with the min/max timestamp and count of their flushed items. The result
+        is cached for COLLECTIONS_STAT_CACHE_TTL seconds, and invalidated when items or collections
+        are created.
+        :return: A list of (collection, min_timestamp, max_timestamp, count) rows
+        """
+
+        cached = self._collections_stat_cache
+
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+
+        results = self._query_collections_item_stat()
+        self._collections_stat_cache = (
+            time.monotonic() + COLLECTIONS_STAT_CACHE_TTL,
+            results,
+        )
+
+        return results
+
+    @with_session
+    def _query_collections_item_stat(self, session: Session) -> list:
+        # The statistics are maintained on flush, collections without items have none
+        # noinspection PyTypeChecker
+        return (
+            session.query(
+                Collection,
+                CollectionStats.min_timestamp,
+                CollectionStats.max_timestamp,
+                func.coalesce(CollectionStats.count, 0),
+            )
+            .outerjoin(CollectionStats)
+            .all()
+        )
+
     @with_session
     def get_collections_buffer_stat(self, session: Session) -> dict:
+        # noinspection PyTypeChecker
+        results = (
+            session.query(
+                BufferedFragment.collection_id,
+                func.min(BufferedSegment.timestamp),
+                func.max(BufferedSegment.timestamp),
+                func.count(BufferedSegment.id),
+            )
+            .join(BufferedSegment)
+            .group_by(BufferedFragment.collection_id)
+            .all()
+        )
+
         buffer_stat = {}
-        for buffer in session.query(BufferedFragment).all():
-            buffer_stat[buffer.collection_id] = {
-                "min_timestamp": datetime.fromtimestamp(
-                    min([segment[2] for segment in buffer.segments] or [0])
-                ),
-                "max_timestamp": datetime.fromtimestamp(
-                    max([segment[2] for segment in buffer.segments] or [0])
-                ),
-                "count": len(buffer.segments),
+        for collection_id, min_timestamp, max_timestamp, count in results:
+            buffer_stat[collection_id] = {
+                "min_timestamp": datetime.fromtimestamp(min_timestamp),
+                "max_timestamp": datetime.fromtimestamp(max_timestamp),
+                "count": count,
             }
 
         return buffer_stat
@@ -152,19 +374,46 @@ class PersistenceManager:
             .all()
         )
 
+    def get_collection_by_name(self, collection_name: str) -> CollectionReference:
+        """
+        Get a collection by its name. As collections are looked up on every operation, their id and
+        name are cached for COLLECTION_CACHE_TTL seconds. Missing collections are not cached.
+        :param collection_name: The name of the collection to get
+        :return: The id and name of the collection with the given name
+        :raises AnotherWorldException: If the collection does not exist
+        """
+
+        cached = self._collection_cache.get(collection_name)
+
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+
+        collection = self._get_collection_by_name(collection_name)
+        self._collection_cache[collection_name] = (
+            time.monotonic() + COLLECTION_CACHE_TTL,
+            collection,
+        )
+
+        return collection
+
     @with_session
-    def get_collection_by_name(
+    def _get_collection_by_name(
         self, session: Session, collection_name: str
-    ) -> Collection:
+    ) -> CollectionReference:
         """
-        Get a collection by its name.
+        Get a collection by its name from the database.
         :param collection_name: The name of the collection to get
-        :return: The collection with the given name
+        :return: The id and name of the collection with the given name
         """
 
         try:
-            # noinspection PyTypeChecker
-            return session.query(Collection).filter_by(name=collection_name).one()
+            # Only the columns are loaded, no ORM instance is bound to the session
+            row = (
+                session.query(Collection.id, Collection.name)
+                .filter_by(name=collection_name)
+                .one()
+            )
+            return CollectionReference(row.id, row.name)
         except NoResultFound:
             raise AnotherWorldException(f"Collection {collection_name} does not exist")
 
@@ -190,80 +439,133 @@ class PersistenceManager:
 
     @with_session
     def append_segments_to_buffer_fragment(
-        self, session: Session, collection_name: str, segments: Tuple[int, int, int]
+        self,
+        session: Session,
+        collection: Collection | str,
+        segments: Tuple[int, int, int],
     ) -> int:
         """
         Append segments to the buffered fragment for the given collection.
         :param session: The session to use
-        :param collection_name: The name of the collection to append the segments to
+        :param collection: The collection (or its name) to append the segments to
         :param segments: The segments to append to the buffered fragment
         :return: The number of segments in the buffered fragment
         """
 
-        collection = self.get_collection_by_name(collection_name)
+        if isinstance(collection, str):
+            collection = self.get_collection_by_name(collection)
 
         # Get or create the buffered fragment
         buffered_fragment = self.get_buffered_fragment(collection)
 
         # Create a new buffered fragment if it does not exist
         if buffered_fragment is None:
-            collection = self.get_collection_by_name(collection_name)
             buffered_fragment = BufferedFragment(
-                collection_id=collection.id, segments=[]
+                collection_id=collection.id, segment_count=0
             )
 
             session.add(buffered_fragment)
+            # The id of the buffered fragment is needed to reference it from its segments
+            session.flush()
+
+        # Append the segments to the buffered fragment, a single row is inserted whatever the
+        # number of segments already in the buffer
+        start, end, timestamp, data_type = segments
+        session.execute(
+            insert(BufferedSegment).values(
+                buffered_fragment_id=buffered_fragment.id,
+                start=start,
+                end=end,
+                timestamp=timestamp,
+                data_type=data_type,
+            )
+        )
 
-        # Append the segments to the buffered fragment
-        buffered_fragment.segments = buffered_fragment.segments + [segments]
+        # The count is kept on the buffered fragment rather than counting its segments. Appends to
+        # a collection are serialized by the engine, so the count read above is still current.
+        segment_count = buffered_fragment.segment_count + 1
+        session.execute(
+            update(BufferedFragment)
+            .where(BufferedFragment.id == buffered_fragment.id)
+            .values(segment_count=BufferedFragment.segment_count + 1)
+        )
 
-        # Associate the buffered fragment to the current session
-        session.add(buffered_fragment)
+        return segment_count
 
-        return len(buffered_fragment.segments)
+    @with_session
+    def get_buffered_segments(
+        self,
+        session: Session,
+        buffered_fragment: BufferedFragment,
+        min_timestamp: int = None,
+        max_timestamp: int = None,
+    ) -> List[Tuple[int, int, int, int]]:
+        """
+        Get the segments of the given buffered fragment, in the order they were appended.
+        :param buffered_fragment: The buffered fragment to get the segments of
+        :param min_timestamp: (Optional) The minimum timestamp of the segments, in seconds
+        :param max_timestamp: (Optional) The maximum timestamp of the segments, in seconds
+        :return: The (start, end, timestamp, data type) of each segment
+        """
+
+        query = select(
+            BufferedSegment.start,
+            BufferedSegment.end,
+            BufferedSegment.timestamp,
+            BufferedSegment.data_type,
+        ).filter(BufferedSegment.buffered_fragment_id == buffered_fragment.id)
+
+        if min_timestamp is not None:
+            query = query.filter(BufferedSegment.timestamp >= min_timestamp)
+
+        if max_timestamp is not None:
+            query = query.filter(BufferedSegment.timestamp <= max_timestamp)
+
+        return [
+            tuple(row) for row in session.execute(query.order_by(BufferedSegment.id))
+        ]
 
     @with_session
-    def has_buffered_fragment(self, session: Session, collection_name: str) -> bool:
+    def has_buffered_fragment(
+        self, session: Session, collection: Collection | str
+    ) -> bool:
         """
         Check if the collection has a buffered fragment.
-        :param collection_name: The name of the collection to check
+        :param collection: The collection (or its name) to check
         :return: True if the collection has a buffered fragment, False otherwise
         """
 
-        collection = self.get_collection_by_name(collection_name)
-        return (
-            session.query(BufferedFragment)
-            .filter_by(collection_id=collection.id)
-            .one_or_none()
-            is not None
-        )
+        return self.get_buffered_fragment(collection) is not None
 
     @with_session
     def associate_new_fragment_to_buffer(
-        self, session: Session, collection_name: str
+        self, session: Session, collection: Collection | str
     ) -> Tuple[List, str]:
         """
         Associate a new fragment to the buffered fragment for the given collection.
-        :param collection_name: The name of the collection to associate the new fragment to
-        :return: The segments of the buffered fragment and the UUID of the new fragment
+        :param collection: The collection (or its name) to associate the new fragment to
+        :return: The segments of the buffered fragment and the UUID of the new fragment (None if the
+        buffered fragment has no segments, in which case no fragment is created)
         :raises AnotherWorldException: If there is no buffered fragment for the collection
         """
 
-        collection = self.get_collection_by_name(collection_name)
+        if isinstance(collection, str):
+            collection = self.get_collection_by_name(collection)
 
         # Get the buffered fragment
-        buffered_fragment = (
-            session.query(BufferedFragment)
-            .filter_by(collection_id=collection.id)
-            .one_or_none()
-        )
+        buffered_fragment = self.get_buffered_fragment(collection)
 
         # Check if there is a buffered fragment
         if buffered_fragment is None:
             raise AnotherWorldException(
-                f"No buffered fragment for {collection_name}, cannot associate a new fragment"
+                f"No buffered fragment for {collection.name}, cannot associate a new fragment"
             )
 
+        segments = self.get_buffered_segments(buffered_fragment)
+
+        if not segments:
+            return segments, None
+
         # Create a new fragment
         fragment = Fragment(
             collection_id=buffered_fragment.collection_id, uuid=str(uuid.uuid4())
@@ -274,53 +576,108 @@ class PersistenceManager:
         buffered_fragment.associated_fragment = fragment
         session.commit()
 
-        return buffered_fragment.segments, fragment.uuid
+        return segments, fragment.uuid
 
     @with_session
     def remove_buffered_fragment_and_create_items(
-        self, session: Session, collection_name: str, metadata: dict
+        self, session: Session, collection: Collection | str, metadata: dict
     ):
         """
         Remove the buffered fragment and create items for the given collection.
 
-        :param collection_name: The name of the collection to remove the buffered fragment and create items for
+        :param collection: The collection (or its name) to remove the buffered fragment and create items for
         :param metadata: The metadata of the data
         :return: None
         :raises AnotherWorldException: If there is no buffered fragment for the collection
         """
 
-        collection = self.get_collection_by_name(collection_name)
+        if isinstance(collection, str):
+            collection = self.get_collection_by_name(collection)
+
         # Get the buffered fragment
-        buffered_fragment = (
-            session.query(BufferedFragment)
-            .filter_by(collection_id=collection.id)
-            .one_or_none()
-        )
+        buffered_fragment = self.get_buffered_fragment(collection)
 
         if buffered_fragment is None:
-            raise AnotherWorldException(f"No buffered fragment for {collection_name}")
+            raise AnotherWorldException(f"No buffered fragment for {collection.name}")
+
+        fragment_id = buffered_fragment.associated_fragment.id
+        collection_id = buffered_fragment.collection_id
 
-        # noinspection PyTypeChecker
         items = [
-            Item(
-                fragment_id=buffered_fragment.associated_fragment.id,
-                collection_id=buffered_fragment.collection_id,
-                timestamp=datetime.fromtimestamp(segment[2]),
-            )
-            for segment in buffered_fragment.segments
+            {
+                "fragment_id": fragment_id,
+                "collection_id": collection_id,
+                "timestamp": datetime.fromtimestamp(segment[2]),
+            }
+            for segment in self.get_buffered_segments(buffered_fragment)
         ]
 
-        # Add the items to the database
-        session.add_all(items)
+        # Add the items to the database with a single bulk insert, the items are not used as
+        # objects afterward so they do not need to be tracked by the session. An empty list of
+        # parameters would insert a single empty row, hence the check.
+        if items:
+            session.execute(insert(Item), items)
+            self._update_collection_stats(
+                collection_id, [item["timestamp"] for item in items]
+            )
 
         # Associate the metadata to the fragment
         buffered_fragment.associated_fragment.internal_metadata = metadata
 
-        # Remove the buffered fragment
+        # Remove the buffered fragment and its segments, the segments are deleted explicitly as
+        # foreign keys are not enforced by every database (e.g. SQLite by default)
+        session.execute(
+            delete(BufferedSegment).where(
+                BufferedSegment.buffered_fragment_id == buffered_fragment.id
+            )
+        )
         session.delete(buffered_fragment)
 
         # Commit the whole transaction
         session.commit()
+        self._collections_stat_cache = None
+
+    @with_session
+    def _update_collection_stats(
+        self, session: Session, collection_id: int, timestamps: List[datetime]
+    ) -> None:
+        """
+        Add the given item timestamps to the statistics of the collection.
+        :param collection_id: The id of the collection the items were created in
+        :param timestamps: The timestamps of the created items
+        :return: None
+        """
+
+        min_timestamp, max_timestamp = min(timestamps), max(timestamps)
+
+        # A single UPDATE, so that concurrent flushes cannot overwrite each other's statistics
+        session.execute(
+            update(CollectionStats)
+            .where(CollectionStats.collection_id == collection_id)
+            .values(
+                count=CollectionStats.count + len(timestamps),
+                min_timestamp=case(
+                    (
+                        or_(
+                            CollectionStats.min_timestamp.is_(None),
+                            CollectionStats.min_timestamp > min_timestamp,
+                        ),
+                        min_timestamp,
+                    ),
+                    else_=CollectionStats.min_timestamp,
+                ),
+                max_timestamp=case(
+                    (
+                        or_(
+                            CollectionStats.max_timestamp.is_(None),
+                            CollectionStats.max_timestamp < max_timestamp,
+                        ),
+                        max_timestamp,
+                    ),
+                    else_=CollectionStats.max_timestamp,
+                ),
+            )
+        )
 
     @with_session
     def query(
@@ -344,7 +701,7 @@ class PersistenceManager:
         :param offset: The offset of the items to retrieve
         :return: The list of fragments in the collection with the given name
         """
-        query = session.query(Item).filter(
+        query = select(Item.fragment_id).filter(
             Item.collection_id == collection.id,
             Item.timestamp >= min_timestamp,
             Item.timestamp <= max_timestamp,
@@ -355,13 +712,14 @@ class PersistenceManager:
         else:
             query = query.order_by(Item.timestamp.desc())
 
-
-        results = query.limit(limit).all()
-
-        # Query the fragments
+        # The fragments holding the first items are fetched in the same query, the ids are made
+        # distinct in a derived table so that the fragment rows (holding JSON) need not be compared
+        fragment_ids = (
+            select(query.limit(limit).subquery().c.fragment_id).distinct().subquery()
+        )
         fragments = (
             session.query(Fragment)
-            .filter(Fragment.id.in_([result.fragment_id for result in results]))
+            .join(fragment_ids, Fragment.id == fragment_ids.c.fragment_id)
             .all()
         )
 
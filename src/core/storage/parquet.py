@@ -2,28 +2,51 @@
 #  All rights reserved.
 
 from datetime import datetime
+from functools import lru_cache
 from io import BytesIO
 from typing import List, Tuple
 
 import pyarrow as pa
+import pyarrow.dataset as ds
 import pyarrow.parquet as pq
 from pyarrow import ArrowInvalid, ArrowNotImplementedError
 
 from src.core.models import DataType
-from src.core.storage.parsers.base import MissMatchingTypesException
+from src.core.storage.parsers.base import BaseParser, MissMatchingTypesException
 from src.core.storage.parsers.bytes_parser import BytesParser
 from src.core.storage.parsers.gtfs_rt_parser import GTFSRTParser
 from src.core.storage.parsers.json_parser import JSONParser
 from src.core.utils.exception import AnotherWorldException
 
-MAPPING = {
-    DataType.JSON: JSONParser(),
-    DataType.GTFS_RT: GTFSRTParser(),
-    DataType.RAW: BytesParser(),
-    # DataType.GTFS: GTFSParser(),
+PARSERS = {
+    DataType.JSON: JSONParser,
+    DataType.GTFS_RT: GTFSRTParser,
+    DataType.RAW: BytesParser,
+    # DataType.GTFS: GTFSParser,
 }
 
 
+@lru_cache(maxsize=None)
+def get_parser(data_type: DataType) -> BaseParser:
+    """
+    Get the parser associated with the data type, falling back to the bytes parser. Parsers are
+    stateless, each one is only instantiated the first time its data type is used.
+    :param data_type: The data type to get the parser for
+    :return: The parser instance
+    """
+    return PARSERS.get(data_type, BytesParser)()
+
+
+# Options used when scanning fragments
+SCAN_OPTIONS = ds.ParquetFragmentScanOptions(pre_buffer=True)
+
+# Codecs for which pyarrow accepts a compression level
+LEVELED_CODECS = {"zstd", "gzip", "brotli"}
+
+# Scanned tables made of at least this many chunks are combined before being sorted
+MIN_NUM_CHUNKS_TO_COMBINE = 4
+
+
 class ParquetDynamicStorage:
     """
     Parquet storage that can handle multiple data types.
@@ -33,10 +56,22 @@ class ParquetDynamicStorage:
         """
         Initialize the Parquet storage with the given settings.
         :param settings: The settings to use
-            - compression: The compression to use (default: snappy)
+            - compression: The compression to use (default: zstd)
+            - compression_level: The compression level to use, ignored by codecs without levels (default: 3)
         """
-        self.compression = settings.get("compression", "gzip")
-        self.compression_level = settings.get("compression_level", "9")
+        self.compression = settings.get("compression", "zstd")
+        compression_level = settings.get("compression_level", 3)
+        self.compression_level = (
+            int(compression_level) if compression_level is not None else None
+        )
+
+        # Options passed to pq.write_table, the level is only given to codecs accepting one
+        self._write_options = {"compression": self.compression}
+        if (
+            self.compression_level is not None
+            and self.compression.lower() in LEVELED_CODECS
+        ):
+            self._write_options["compression_level"] = self.compression_level
 
     def write(
         self,
@@ -44,81 +79,109 @@ class ParquetDynamicStorage:
         output: BytesIO,
         data_type: DataType = None,
     ) -> dict:
-            """
-            Write the data to the output stream, with the given data type.
-
-            The objective of this method is to write the data to the output stream using Parquet format.
-            To best handle the data, the method will try to infer the data type if not provided.
-            Then, it will try to parse the data using the parser associated with the data type.
-            If the parsing fails, it will try to write the data with the raw data type.
-
-            :param data: The data to write as a list of tuples of bytes and datetime
-            :param output: The output stream to write the data to
-            :param data_type: The data type of the data to write
-            :return: A dictionary with the metadata of the written data
-            """
-            assert len(data) > 0, "Data must not be empty"
-
-            # Infer data type if not provided (try to parse the first item, and if it fails, return raw)
-            if data_type is None:
-                data_type = DataType.RAW
-
-            # Then determine the parser to use
-            parser = MAPPING.get(data_type, BytesParser()).parse
-
-            # This is a temporary list to store the parsed data
-            parsed_data = []
-
-            # For each item in the data, try to parse it, and if it fails,
-            # run the write method again with the raw data type for ALL the data
-            # This is to avoid writing a mix of data types in the same parquet file.
+        """
+        Write the data to the output stream, with the given data type.
+
+        The objective of this method is to write the data to the output stream using Parquet format.
+        To best handle the data, the method will try to infer the data type if not provided.
+        Then, it will try to parse the data using the parser associated with the data type.
+        If the parsing fails, it will try to write the data with the raw data type.
+
+        :param data: The data to write as a list of tuples of bytes and datetime
+        :param output: The output stream to write the data to
+        :param data_type: The data type of the data to write
+        :return: A dictionary with the metadata of the written data
+        """
+        assert len(data) > 0, "Data must not be empty"
+
+        # Infer data type if not provided (try to parse the first item, and if it fails, return raw)
+        if data_type is None:
+            data_type = DataType.RAW
+
+        table = self._to_table(data, data_type)
+
+        # If the data does not match its data type, ALL the data is written as raw data
+        # This is to avoid writing a mix of data types in the same parquet file.
+        if table is None:
+            data_type = DataType.RAW
+            table = self._to_table(data, data_type)
+
+        # Fragments are stored ordered by timestamp, so that reads can stop early
+        table = table.sort_by([("timestamp", "ascending")])
+
+        # Collects the footer of the written file, to avoid reading it back for its schema
+        metadata_collector = []
+
+        # Write the table to the output stream
+        pq.write_table(
+            table,
+            output,
+            # Dictionary encoding cannot pay off on a single row
+            use_dictionary=table.num_rows > 1,
+            # Statistics are only used to filter fragments on their timestamps
+            write_statistics=["timestamp"],
+            metadata_collector=metadata_collector,
+            **self._write_options,
+        )
+
+        return {
+            "data_type": data_type.value,
+            "schema": f"{metadata_collector[0].schema}",
+            "sorted": True,
+        }
+
+    @staticmethod
+    def _to_table(
+        data: List[Tuple[bytes, datetime]], data_type: DataType
+    ) -> pa.Table | None:
+        """
+        Parse the data with the parser associated with the data type and build its Arrow table.
+        :param data: The data to convert as a list of tuples of bytes and datetime
+        :param data_type: The data type of the data
+        :return: The table, or None if the data cannot be represented with the given data type
+        :raises AnotherWorldException: If the data cannot be represented, even as raw data
+        """
+        # The data is split into its two columns in a single pass, so the table can be
+        # built from them directly without re-walking the parsed data
+        data_column = []
+        timestamp_column = []
+
+        if data_type == DataType.RAW:
+            # Raw data is stored as is, there is nothing to parse
             for item in data:
-                try:
-                    representation = parser(item[0])
-                    parsed_data.append((representation, item[1]))
-                except MissMatchingTypesException as e:
-                    return self.write(data, output, DataType.RAW)
-
-            try:
-                table = pa.Table.from_arrays(
-                    arrays=[
-                        pa.array([item[0] for item in parsed_data]),
-                        pa.array([item[1] for item in parsed_data]),
-                    ],
-                    schema=pa.schema(
-                        [
-                            pa.field(
-                                "data", pa.infer_type([item[0] for item in parsed_data])
-                            ),
-                            pa.field("timestamp", pa.int64()),
-                        ]
-                    ),
-                )
-            except (ArrowInvalid, ArrowNotImplementedError) as e:
-                if data_type == DataType.RAW:
-                    raise AnotherWorldException(
-                        "Cannot write raw data to parquet, even if it's not parsed"
-                    )
-                return self.write(data, output, DataType.RAW)
-
-            local_output = BytesIO()
-
-            # Write the table to the output stream
-            pq.write_table(
-                table,
-                local_output,
-                compression=self.compression,
-                use_dictionary=True,
-                compression_level=self.compression_level,
-            )
+                data_column.append(item[0])
+                timestamp_column.append(item[1])
+        else:
+            parser = get_parser(data_type).parse
 
-            output.write(local_output.getvalue())
+            for item in data:
+                try:
+                    data_column.append(parser(item[0]))
+                except MissMatchingTypesException:
+                    return None
+                timestamp_column.append(item[1])
 
-            pq_file = pq.ParquetFile(BytesIO(local_output.getvalue()))
-            return {
-                "data_type": data_type.value,
-                "schema": f"{pq_file.schema}",
-            }
+        try:
+            # The type of the data is inferred once, while building its array
+            data_array = pa.array(data_column)
+            return pa.Table.from_arrays(
+                arrays=[
+                    data_array,
+                    pa.array(timestamp_column, type=pa.int64()),
+                ],
+                schema=pa.schema(
+                    [
+                        pa.field("data", data_array.type),
+                        pa.field("timestamp", pa.int64()),
+                    ]
+                ),
+            )
+        except (ArrowInvalid, ArrowNotImplementedError):
+            if data_type == DataType.RAW:
+                raise AnotherWorldException(
+                    "Cannot write raw data to parquet, even if it's not parsed"
+                )
+            return None
 
     def read(
         self,
@@ -144,40 +207,96 @@ class ParquetDynamicStorage:
         :return: The data read as a list of tuples of bytes and datetime
         """
         data_type = DataType(metadata["data_type"])
-        serialize = MAPPING.get(data_type, BytesParser()).serialize
-        reader = BytesIO(reader.read())
 
-        table_filters = []
+        timestamp = ds.field("timestamp")
+        scan_filter = None
 
         if "min_timestamp" in where:
-            table_filters.append(
-                ("timestamp", ">=", int(where["min_timestamp"].timestamp()))
-            )
+            scan_filter = timestamp >= int(where["min_timestamp"].timestamp())
         if "max_timestamp" in where:
-            table_filters.append(
-                ("timestamp", "<=", int(where["max_timestamp"].timestamp()))
+            max_filter = timestamp <= int(where["max_timestamp"].timestamp())
+            scan_filter = (
+                max_filter if scan_filter is None else scan_filter & max_filter
             )
 
-        table = pq.read_table(reader, filters=table_filters)
+        # The filter is evaluated by the scan itself, skipping row groups using their statistics.
+        # Column chunks are pre-buffered into coalesced reads and decoded by multiple threads.
+        fragment = ds.ParquetFileFormat().make_fragment(reader)
+        scanner = fragment.scanner(
+            columns=["data", "timestamp"],
+            filter=scan_filter,
+            use_threads=True,
+            fragment_scan_options=SCAN_OPTIONS,
+        )
 
-        data = table.to_pandas()
+        descending = bool(order_by and "timestamp desc" in order_by)
 
-        filtered_data = []
+        if limit and metadata.get("sorted") and not descending:
+            # The fragment is already in ascending order, only the first rows need to be read
+            table = scanner.head(limit)
+        else:
+            if limit and metadata.get("sorted"):
+                # The latest rows of the fragment are in its last row groups, only those are read
+                table = self._read_last_row_groups(fragment, scan_filter, limit)
+            else:
+                table = scanner.to_table()
 
-        if order_by and "timestamp" in order_by:
-            data.sort_values("timestamp")
-        elif order_by and "timestamp desc" in order_by:
-            data = data.sort_values("timestamp", ascending=False)
+            # The scan returns one chunk per batch, sorting and slicing a single chunk is cheaper
+            if table.column("timestamp").num_chunks >= MIN_NUM_CHUNKS_TO_COMBINE:
+                table = table.combine_chunks()
 
-        if limit:
-            data = data[:limit]
-        for i, row in data.iterrows():
-            filtered_data.append(
-                (
-                    serialize(row["data"]),
-                    row["timestamp"],
-                )
+            if order_by and "timestamp" in order_by:
+                table = table.sort_by([("timestamp", "ascending")])
+            elif descending:
+                table = table.sort_by([("timestamp", "descending")])
+
+            if limit:
+                table = table.slice(0, limit)
+
+        # Walk the two columns directly rather than going through a row-wise representation
+        data_column = table.column("data").to_pylist()
+        timestamp_column = table.column("timestamp").to_pylist()
+
+        # Raw data is stored as is, there is nothing to serialize
+        if data_type == DataType.RAW:
+            return list(zip(data_column, timestamp_column))
+
+        serialize = get_parser(data_type).serialize
+
+        return [
+            (serialize(data), timestamp)
+            for data, timestamp in zip(data_column, timestamp_column)
+        ]
+
+    @staticmethod
+    def _read_last_row_groups(
+        fragment: ds.ParquetFileFragment, scan_filter: ds.Expression | None, limit: int
+    ) -> pa.Table:
+        """
+        Read the row groups of a sorted fragment from the last one, until at least limit rows are found.
+        Row groups not matching the filter are skipped using their statistics.
+        :param fragment: The fragment to read, sorted by ascending timestamp
+        :param scan_filter: The filter to apply to the rows
+        :param limit: The number of rows to find
+        :return: The rows found, in no particular order
+        """
+        tables = []
+        remaining = limit
+
+        for row_group in reversed(fragment.split_by_row_group(scan_filter)):
+            table = row_group.to_table(
+                columns=["data", "timestamp"],
+                filter=scan_filter,
+                use_threads=True,
+                fragment_scan_options=SCAN_OPTIONS,
             )
+            tables.append(table)
+            remaining -= table.num_rows
+
+            if remaining <= 0:
+                break
 
-        return filtered_data
+        if not tables:
+            return fragment.scanner(columns=["data", "timestamp"]).head(0)
 
+        return pa.concat_tables(tables)
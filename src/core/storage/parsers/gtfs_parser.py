@@ -1,7 +1,6 @@
 #  Copyright (c) 2024. Gaspard Merten
 #  All rights reserved.
-from collections import defaultdict
-from typing import List, Dict
+from io import StringIO
 
 import pandas as pd
 
@@ -9,36 +8,20 @@ from src.core.storage.parsers.base import BaseParser, MissMatchingTypesException
 from src.core.utils.zip_tools import zip_to_dict, dict_to_zip
 
 
-def string_line_to_typed_list(line: str, types: list) -> list:
+def read_csv_content(content: str) -> pd.DataFrame:
     """
-    Convert a string line to a typed list.
-    :param types: The types to convert the line to a list
-    :param line: The line to convert
-    :return: The typed list
+    Parse a CSV file using the C engine of pandas, which infers the column types in the same pass.
+    Empty cells are kept as empty strings (and thus make their column textual) instead of becoming NaN.
+    :param content: The content of the CSV file
+    :return: The parsed CSV file
     """
-    return [parser(value) for value, parser in zip(line.split(","), types)]
-
-
-def infer_types(content: List[str]) -> List[type]:
-    """
-    Infer the types of the content.
-    :param content: The content to infer the types from
-    :return: The types of the content
-    """
-
-    # noinspection PyTypeChecker
-    types: Dict[int, type] = defaultdict(str)
-
-    for line in content:
-        for i, value in enumerate(line.split(",")):
-            if value.isdigit() and types[i] != str and types[i] != float:
-                types[i] = int
-            elif value.replace(".", "").isdigit() and types[i] != str:
-                types[i] = float
-            else:
-                types[i] = str
-
-    return [types[i] for i in range(len(types))]
+    return pd.read_csv(
+        StringIO(content),
+        engine="c",
+        keep_default_na=False,
+        skip_blank_lines=True,
+        on_bad_lines="skip",
+    )
 
 
 class GTFSParser(BaseParser):
@@ -48,32 +31,14 @@ class GTFSParser(BaseParser):
             out = {}
 
             for file, content in files.items():
-                content_as_lines = (
-                    content.splitlines()
-                )  # More efficient than split("\n")
-                header, *content_lines = content_as_lines
-                header = header.split(",")
-                output = []
-                types = infer_types(content_lines)
-
-                for line in content_lines:
-                    if (
-                        not line.strip()
-                    ):  # Simplify the check for empty or whitespace-only lines
-                        continue
-                    try:
-                        line_as_dict = dict(
-                            zip(header, string_line_to_typed_list(line, types))
-                        )
-                        output.append(line_as_dict)
-                    except ValueError:
-                        continue
-
-                out[file] = {"header": header, "content": output}
+                df = read_csv_content(content)
+                out[file] = {
+                    "header": df.columns.tolist(),
+                    "content": df.to_dict("records"),
+                }
 
             return out
-        except Exception as e:
-            print("Error while parsing GTFS data:", e)
+        except Exception:
             raise MissMatchingTypesException()
 
     def serialize(self, data: dict) -> bytes:
@@ -1,15 +1,12 @@
 #  Copyright (c) 2024. Gaspard Merten
 #  All rights reserved.
 
-import json
-
 from google.protobuf import json_format
 from google.protobuf.json_format import MessageToDict, SerializeToJsonError
 from google.protobuf.message import DecodeError
 from google.transit import gtfs_realtime_pb2
 
 from src.core.storage.parsers.base import BaseParser, MissMatchingTypesException
-from src.core.utils.numpy_json import NumpyEncoder
 
 
 class GTFSRTParser(BaseParser):
@@ -25,5 +22,6 @@ class GTFSRTParser(BaseParser):
     def serialize(self, data: bytes | str | object) -> bytes:
         # noinspection PyUnresolvedReferences
         feed = gtfs_realtime_pb2.FeedMessage()
-        json_format.Parse(json.dumps(data, cls=NumpyEncoder), feed)
+        # The dict is loaded into the message directly, without a round trip through a JSON string
+        json_format.ParseDict(data, feed)
         return feed.SerializeToString()
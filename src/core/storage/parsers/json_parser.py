@@ -1,20 +1,34 @@
 #  Copyright (c) 2024. Gaspard Merten
 #  All rights reserved.
 
-import json
-
 from src.core.storage.parsers.base import BaseParser, MissMatchingTypesException
-from src.core.utils.numpy_json import NumpyEncoder
+
+try:
+    import orjson
+
+    loads = orjson.loads
+
+    def dumps(data: object) -> bytes:
+        return orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY)
+
+except ImportError:
+    import json
+
+    from src.core.utils.numpy_json import NumpyEncoder
+
+    loads = json.loads
+
+    def dumps(data: object) -> bytes:
+        return json.dumps(data, cls=NumpyEncoder).encode()
 
 
 class JSONParser(BaseParser):
     def parse(self, data: bytes) -> bytes | str | object | None:
         try:
-            return json.loads(data)
-        except json.JSONDecodeError:
-            raise MissMatchingTypesException()
-        except UnicodeError:
+            return loads(data)
+        except ValueError:
+            # Covers both JSON decoding errors and invalid UTF-8 input
             raise MissMatchingTypesException()
 
     def serialize(self, data: dict) -> bytes:
-        return json.dumps(data, cls=NumpyEncoder).encode()
+        return dumps(data)
@@ -1,8 +1,6 @@
 #  Copyright (c) 2024. Gaspard Merten
 #  All rights reserved.
 
-from typing import List, Tuple
-
 from sqlalchemy import ForeignKey, DateTime, JSON
 from sqlalchemy import String
 from sqlalchemy.orm import DeclarativeBase, relationship
@@ -40,7 +38,7 @@ class BufferedFragment(Base):
 
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     collection_id: Mapped[int] = mapped_column(ForeignKey("collection.id"), unique=True)
-    segments: Mapped[List[Tuple[int, int, int]]] = mapped_column(JSON)
+    segment_count: Mapped[int] = mapped_column(default=0)
     fragment_id: Mapped[int] = mapped_column(
         ForeignKey("fragment.id", ondelete="SET NULL"), nullable=True
     )
@@ -50,6 +48,38 @@ class BufferedFragment(Base):
         return f"BufferedFragment(id={self.id!r})"
 
 
+class BufferedSegment(Base):
+    __tablename__ = "buffered_segment"
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    buffered_fragment_id: Mapped[int] = mapped_column(
+        ForeignKey("buffered_fragment.id", ondelete="CASCADE"), index=True
+    )
+    start: Mapped[int] = mapped_column()
+    end: Mapped[int] = mapped_column()
+    timestamp: Mapped[int] = mapped_column()
+    data_type: Mapped[int] = mapped_column(nullable=True)
+
+    def __repr__(self) -> str:
+        return (
+            f"BufferedSegment(id={self.id!r}, start={self.start!r}, end={self.end!r})"
+        )
+
+
+class CollectionStats(Base):
+    __tablename__ = "collection_stats"
+
+    collection_id: Mapped[int] = mapped_column(
+        ForeignKey("collection.id"), primary_key=True
+    )
+    min_timestamp: Mapped[str] = mapped_column(DateTime, nullable=True)
+    max_timestamp: Mapped[str] = mapped_column(DateTime, nullable=True)
+    count: Mapped[int] = mapped_column(default=0)
+
+    def __repr__(self) -> str:
+        return f"CollectionStats(collection_id={self.collection_id!r}, count={self.count!r})"
+
+
 class Item(Base):
     __tablename__ = "item"
 
@@ -0,0 +1,34 @@
+#  Copyright (c) 2024. Gaspard Merten
+#  All rights reserved.
+
+import os
+
+try:
+    import fcntl
+
+    def _lock(fd: int) -> None:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+except ImportError:
+    import msvcrt
+
+    def _lock(fd: int) -> None:
+        msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+
+
+def try_lock_file(path: str) -> int | None:
+    """
+    Try to acquire an exclusive advisory lock on the given file, without blocking. The lock is held
+    until the returned file descriptor is closed.
+    :param path: The path of the lock file, created if it does not exist
+    :return: The file descriptor holding the lock, or None if the lock is held by another process
+    """
+    fd = os.open(path, os.O_RDWR | os.O_CREAT)
+
+    try:
+        _lock(fd)
+    except OSError:
+        os.close(fd)
+        return None
+
+    return fd
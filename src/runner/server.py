@@ -2,7 +2,10 @@
 #  All rights reserved.
 
 
+import asyncio
+import functools
 import os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 import fastapi
@@ -11,7 +14,11 @@ from pydantic import BaseModel
 from src.core.io_manager.file_system import FileSystemIOManager
 from src.core.models import DataType
 from src.core.orchestrator import Orchestrator
-from src.core.persistence import PersistenceManager
+from src.core.persistence import (
+    PersistenceManager,
+    DEFAULT_POOL_SIZE,
+    DEFAULT_MAX_OVERFLOW,
+)
 from src.core.storage.parquet import ParquetDynamicStorage
 
 __all__ = ["app"]
@@ -20,20 +27,37 @@ from src.core.utils.exception import AnotherWorldException
 
 app = fastapi.FastAPI()
 
+# Number of threads running the blocking write operations
+DEFAULT_WRITE_WORKERS = 16
+
 core = Orchestrator(
-    PersistenceManager(os.environ.get("DB_URL", "sqlite:///sqlite3.db")),
+    PersistenceManager(
+        os.environ.get("DB_URL", "sqlite:///sqlite3.db"),
+        pool_size=int(os.environ.get("DB_POOL_SIZE", DEFAULT_POOL_SIZE)),
+        max_overflow=int(os.environ.get("DB_MAX_OVERFLOW", DEFAULT_MAX_OVERFLOW)),
+    ),
     FileSystemIOManager(os.environ.get("STORAGE_PATH", "storage")),
     ParquetDynamicStorage(
         compression=os.environ.get("COMPRESSION", "snappy"),
-        compression_level=(os.environ.get("COMPRESSION_LEVEL", None)),
+        compression_level=os.environ.get("COMPRESSION_LEVEL"),
     ),
 )
 
+# Queries are blocking, they are run outside the event loop in a pool bounded to the number of CPUs
+query_executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 4)
+# Stores, flushes and collection creations are blocking too (disk and database), they get their own
+# pool so that they do not wait behind long queries
+write_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("WRITE_WORKERS", DEFAULT_WRITE_WORKERS))
+)
+
 
 @app.get("/collections/")
 async def all_collections():
     try:
-        return core.list_collections()
+        return await asyncio.get_running_loop().run_in_executor(
+            query_executor, core.list_collections
+        )
     except AnotherWorldException as e:
         return {"error": str(e)}
 
@@ -62,8 +86,15 @@ async def query_collection(
     max_timestamp = datetime.fromtimestamp(max_timestamp/1000)
 
     try:
-        results = core.query(
-            collection_name, min_timestamp, max_timestamp, ascending, limit, offset
+        results = await asyncio.get_running_loop().run_in_executor(
+            query_executor,
+            core.query,
+            collection_name,
+            min_timestamp,
+            max_timestamp,
+            ascending,
+            limit,
+            offset,
         )
     except AnotherWorldException as e:
         return {"results": [], "error": str(e)}
@@ -88,7 +119,9 @@ async def flush_buffer(collection_name: str):
     :return: None
     """
     try:
-        core.flush(collection_name)
+        await asyncio.get_running_loop().run_in_executor(
+            write_executor, core.flush, collection_name
+        )
     except AnotherWorldException as e:
         return {"error": str(e)}
 
@@ -103,7 +136,12 @@ async def create_collection(collection: CollectionRequest):
     :return: None
     """
     try:
-        core.create_collection(collection.name, allow_existing=True)
+        await asyncio.get_running_loop().run_in_executor(
+            write_executor,
+            functools.partial(
+                core.create_collection, collection.name, allow_existing=True
+            ),
+        )
     except AnotherWorldException as e:
         return {"error": str(e)}
 
@@ -128,7 +166,8 @@ async def store_data(request: StoreRequest, collection_name: str):
     # Convert timestamp to datetime
     timestamp = datetime.fromtimestamp(request.timestamp)
 
-    try:
+    def store():
+        # The payload is decoded in the executor as well, it is the most expensive step for large payloads
         core.store(
             collection_name,
             timestamp,
@@ -136,6 +175,9 @@ async def store_data(request: StoreRequest, collection_name: str):
             data_type=DataType(request.content_type) if request.content_type is not None else None,
             create_collection=request.create_collection,
         )
+
+    try:
+        await asyncio.get_running_loop().run_in_executor(write_executor, store)
     except AnotherWorldException as e:
         return {"error": str(e)}
 